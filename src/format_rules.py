@@ -1,23 +1,130 @@
+import bisect
+import functools
 import re
 from tree_sitter import Language, Parser, Tree, Node
 
+#### Regular Expressions
+# Compiled once here rather than looked up in the re module's cache
+# every time a rule is run.
+MULTIPLE_SPACES_REGEX = re.compile(b" {2,}")
+SPACE_BEFORE_SEMICOLON_REGEX = re.compile(b" ;")
+ARG_KEYWORD_REGEX = re.compile(b"^arg |;$")
+SPACE_WITHOUT_COMMA_REGEX = re.compile(b"(?<!,) ")
+
+#### Queries
+# Helpers.get_query compiles each of these only once per language.
+FUNCTION_BLOCK_QUERY = """
+  (function_block) @function_block
+  """
+
+NEWLINE_ELEMENTS_QUERY = """
+  ("[") @no_newline_both
+  ("]") @no_newline_to_left
+  (".") @no_newline_both
+  ("|") @no_newline_both
+  ("{") @no_newline_to_right
+  ("}") @no_newline_to_left
+  ("(") @no_newline_to_right
+  (")") @no_newline_to_left
+  """
+
+BRACKET_QUERY = """
+  ("(") @no_space_opening
+  (")") @no_space_closing
+  ("[") @no_space_opening
+  ("]") @no_space_closing
+  ("{") @space_opening
+  ("}") @space_closing
+  """
+
+BINARY_EXPRESSION_QUERY = """
+  (binary_expression) @binary_exp
+  """
+
+COMMA_QUERY = """
+  (",") @comma
+  """
+
+ASSIGNMENT_QUERY = """
+  ("=") @assignment
+  """
+
+PARAMETER_LIST_QUERY = """
+  (parameter_list) @parameter_list
+  """
+
+#### Characters
+# The data is handled as UTF-8 encoded bytes, so indexing into it gives
+# back the integer value of the byte rather than a one character string.
+NEWLINE = ord("\n")
+SPACE = ord(" ")
+
+# Statements starting with this are variable declarations. Node.text is
+# already bytes, so this is checked without decoding the node's text.
+VAR_STATEMENT_PREFIX = b"var "
+
+#### Node Types
+# Node types that open a new block for the indentation. The type of every
+# node in the tree is checked against these, so keep them in a frozenset.
+SIGNIFICANT_NODE_TYPES = frozenset(
+    [
+        "arithmetic_series",
+        "code_block",
+        "function_block",
+        "method_name",
+        "variable_definition",
+    ]
+)
+
+# Children of a function block that can't be its return statement.
+NON_RETURN_NODE_TYPES = frozenset([";", "}"])
+
+# Children of a function block that don't count as statements.
+NON_STATEMENT_NODE_TYPES = frozenset([";", "parameter_list", "{", "}"])
+
 # Interface for Format Rule
+#
+# The private formatter returns the new data and either the tree it was
+# handed, with every change already reported to it through tree.edit (see
+# Helpers.apply_edits), or None if it changed the data some other way and
+# the tree has to be rebuilt from scratch.
 class FormatRule(object):
 
     # Public
     @classmethod
     def format(self, arguments, data, tree, parser, language):
         # Use the private formatter
-        data, tree = self.__format(arguments, data, tree, parser, language)
+        new_data, new_tree = self._format(
+            arguments, data, tree, parser, language
+        )
 
-        # Rebuild the tree from the existing tree
-        # tree = Helpers.get_tree(parser, data, tree)
-        tree = Helpers.get_tree(parser, data, None)
-        return data, tree
+        # If nothing changed, the tree is still good as it is.
+        if new_data == data:
+            return data, tree
+
+        # Rebuild the tree from the existing tree, so the tree-sitter only
+        # has to reparse the parts that were edited.
+        tree = Helpers.get_tree(parser, new_data, new_tree)
+        return new_data, tree
 
     # Private
     @staticmethod
-    def __format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
+        raise NotImplementedError
+
+
+# Interface for rules that only add or remove characters next to what they
+# match. Rather than editing the data themselves, they return a list of
+# edits, so several of them can be applied at once (see SpacingPass).
+class SpacingRule(FormatRule):
+    @classmethod
+    def _format(cls, arguments, data, tree, parser, language):
+        edits = cls.get_edits(arguments, data, tree, language)
+        data = Helpers.apply_edits(data, edits, tree)
+        return data, tree
+
+    @staticmethod
+    def get_edits(arguments, data, tree, language):
         raise NotImplementedError
 
 
@@ -25,61 +132,60 @@ class FormatRule(object):
 
 
 class Helpers(object):
+    # Compiling a query parses the S-expression pattern every time, but the
+    # patterns are fixed for each rule. Cache the compiled query per language
+    # so it's only built once per run.
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_query(language, query):
+        return language.query(query)
+
+    # Rules that don't change the data hand the same tree on to the next rule,
+    # and some rules run the same query (e.g. the parameter list rules), so
+    # memoize the results. The data is part of the key because a tree that
+    # has been edited in place is only the same tree for the same data.
     @staticmethod
-    def get_query_result_and_newline_data(tree, query, data):
+    @functools.lru_cache(maxsize=16)
+    def get_query_result(tree, query, data):
 
-        # Sort the results so that the match that is at the last position
+        # Reverse the results so that the match that is at the last position
         # is the first in the list. This way we can edit the string in
         # place and only rebuild the tree after all the edits have been
         # made.
-
-        # TODO: why doesn't this return properly all the time ?
-
-        captures = sorted(query.captures(tree.root_node))
-        captures.reverse()
-
-        newline_offsets = Helpers.get_all_newline_offsets(data)
-
-        return captures, newline_offsets
-
+        #
+        # The tree-sitter already returns the captures in the order they
+        # appear in the file. Nodes don't define an ordering, so sorting
+        # them only compared the capture names and didn't do anything
+        # useful - reversing the list is all that's needed.
+        #
+        # NB: Rules locate their matches with the node's start_byte and
+        # end_byte. The data is kept as the same UTF-8 bytes the tree was
+        # parsed from, so these are offsets into the data.
+        return tuple(reversed(query.captures(tree.root_node)))
+
+    # Every edit reported to a tree needs the newline offsets of the data,
+    # and rules that don't change anything hand the same data to the next
+    # rule.
+    # Memoize on the data so the table is only rebuilt after an edit. The
+    # offsets are returned as a tuple so a caller can't corrupt the cache.
     @staticmethod
+    @functools.lru_cache(maxsize=8)
     def get_all_newline_offsets(data):
-        # Use the positive lookbehind technique to match
-        # the character after the newline. (.|\n) means either a character
-        # or a newline, as it's possible to have multiple newlines in a row
-        # and we want to account for that. The [0] means the 0th
-        # character is always the start of the first line.
-        return [0] + [
-            match.start() for match in re.finditer("(?<=\n)(.|\n)", data)
-        ]
-
-    @staticmethod
-    def position_offset(data, line, offset):
-        i = 0
-        current_line = 0
-        current_offset = 0
-        for char in data:
-            # If we have found the character, return
-            if current_line is line and current_offset is offset:
-                return i
-
-            # Continue iterating
-            if char == "\n":
-                i = i + 1
-                current_line = current_line + 1
-                current_offset = 0
-            else:
-                i = i + 1
-                current_offset = current_offset + 1
+        # Every line starts one byte after a newline. bytes.find
+        # is a memchr-style scan in C, so walking the newlines this
+        # way is much cheaper than running the regex engine over the
+        # whole file. The [0] means the 0th character is always the
+        # start of the first line.
+        newline_offsets = [0]
+        position = data.find(b"\n")
+        while position != -1:
+            newline_offsets.append(position + 1)
+            position = data.find(b"\n", position + 1)
+
+        return tuple(newline_offsets)
 
     @staticmethod
     def replace_range(data, start_offset, end_offset, new_data):
-        print("############")
-        print(
-            "Start: " + str(start_offset) + " [" + str(data[start_offset]) + "]"
-        )
-        print("End: " + str(end_offset) + " [" + str(data[end_offset]) + "]")
-        print("############")
         return new_data.join([data[:start_offset], data[end_offset:]])
 
     # @staticmethod
@@ -93,36 +199,109 @@ class Helpers(object):
         # Find where this represents in the string
         # remove that chunk / insert edited text into that chunk
 
+    @staticmethod
+    def apply_edits(data, edits, tree=None):
+        # Edits are (start, end, new_data) tuples whose offsets all refer to
+        # the unedited data. Rather than splicing the data once per edit,
+        # which copies the whole string every time, collect the untouched
+        # slices and the replacements and join them once.
+        #
+        # Identical edits are only applied once (e.g. "{}" asks for the same
+        # space from both brackets) and an edit that overlaps one before it
+        # is dropped, as the data it refers to is already gone.
+        #
+        # If a tree is passed in, every applied edit is reported to it so it
+        # can be reparsed incrementally.
+        #
+        # Already formatted code gives no edits - hand the data back as it
+        # is, without copying it or building the newline table for the tree.
+        if not edits:
+            return data
+
+        pieces = []
+        applied_edits = []
+        position = 0
+        for start, end, new_data in sorted(set(edits)):
+            if start < position:
+                continue
+            pieces.append(data[position:start])
+            pieces.append(new_data)
+            applied_edits.append((start, end, new_data))
+            position = end
+        pieces.append(data[position:])
+
+        if tree is not None:
+            Helpers.edit_tree(tree, data, applied_edits)
+
+        return data[:0].join(pieces)
+
+    @staticmethod
+    def edit_tree(tree, data, edits):
+        # Report the edits to the tree from the last to the first. That way
+        # the offsets of each edit, which refer to the unedited data, are
+        # still correct when it is reported, as only the data after it has
+        # changed so far.
+        newline_offsets = Helpers.get_all_newline_offsets(data)
+        for start, end, new_data in reversed(edits):
+            start_point = Helpers.get_point(newline_offsets, start)
+            tree.edit(
+                # Bytes
+                start_byte=start,
+                old_end_byte=end,
+                new_end_byte=start + len(new_data),
+                # Nodes
+                start_point=start_point,
+                old_end_point=Helpers.get_point(newline_offsets, end),
+                new_end_point=Helpers.get_end_point(start_point, new_data),
+            )
+
+    @staticmethod
+    def get_point(newline_offsets, offset):
+        # Find the line the offset is on with a binary search over the
+        # start of each line.
+        line = bisect.bisect_right(newline_offsets, offset) - 1
+        return (line, offset - newline_offsets[line])
+
+    @staticmethod
+    def get_end_point(start_point, new_data):
+        # Where inserted data ends, given where it starts.
+        newlines = new_data.count(b"\n")
+        if newlines == 0:
+            return (start_point[0], start_point[1] + len(new_data))
+        return (
+            start_point[0] + newlines,
+            len(new_data) - new_data.rfind(b"\n") - 1,
+        )
+
     @staticmethod
     def get_tree(parser, data, tree):
+        # The data is already encoded, so it can be handed to the parser
+        # as is.
         if tree is None:
-            return parser.parse(bytes(data, "utf8"))
+            return parser.parse(data)
         else:
-            return parser.parse(bytes(data, "utf8"), tree)
+            return parser.parse(data, tree)
 
     @staticmethod
-    def get_significant_tree_nodes(newline_offsets, tree: Tree):
+    def get_significant_tree_nodes(tree: Tree):
         cursor = tree.walk()
 
-        nodes_to_investigate = [
-            "arithmetic_series",
-            "code_block",
-            "function_block",
-            "method_name",
-            "variable_definition",
-        ]
+        nodes_to_investigate = SIGNIFICANT_NODE_TYPES
 
         reached_root = False
         level = 0
         parents = []
         end_of_block = []
+        # Every access to cursor.node builds a new Node object on the Python
+        # side, so fetch it once after each move of the cursor and reuse it.
+        node = cursor.node
         while reached_root == False:
 
-            if cursor.node.type in nodes_to_investigate:
-                yield cursor.node, level, end_of_block
+            if node.type in nodes_to_investigate:
+                yield node, level, end_of_block
 
             # print(
-            #     Helpers.get_start_of_node(cursor.node, newline_offsets) + 1,
+            #     Helpers.get_start_of_node(cursor.node) + 1,
             #     cursor.node.type,
             #     cursor.node.text,
             #     end_of_block,
@@ -130,73 +309,63 @@ class Helpers(object):
 
             if (
                 len(end_of_block) > 0
-                and Helpers.get_start_of_node(cursor.node, newline_offsets)
-                >= end_of_block[-1]
+                and Helpers.get_start_of_node(node) >= end_of_block[-1]
             ):
                 end_of_block.pop()
 
             if cursor.goto_first_child():
-                if cursor.node.type in nodes_to_investigate:
+                node = cursor.node
+                if node.type in nodes_to_investigate:
                     level = level + 1
                     # parents.append(cursor.node)
                     # print(
                     #     "***** APPENDING %s - %d - %d"
                     #     % (
                     #         cursor.node,
-                    #         Helpers.get_length_of_node(
-                    #             cursor.node, newline_offsets
-                    #         ),
-                    #         Helpers.get_end_of_node(
-                    #             cursor.node, newline_offsets
-                    #         ),
+                    #         Helpers.get_length_of_node(cursor.node),
+                    #         Helpers.get_end_of_node(cursor.node),
                     #     )
                     # )
-                    end_of_block.append(
-                        Helpers.get_end_of_node(cursor.node, newline_offsets)
-                    )
+                    end_of_block.append(Helpers.get_end_of_node(node))
                 continue
 
             if cursor.goto_next_sibling():
-                if cursor.node.type in nodes_to_investigate:
+                node = cursor.node
+                if node.type in nodes_to_investigate:
                     # parents.append(cursor.node)
                     # print(
                     #     "***** APPENDING %s - %d - %d"
                     #     % (
                     #         cursor.node,
-                    #         Helpers.get_length_of_node(
-                    #             cursor.node, newline_offsets
-                    #         ),
-                    #         Helpers.get_end_of_node(
-                    #             cursor.node, newline_offsets
-                    #         ),
+                    #         Helpers.get_length_of_node(cursor.node),
+                    #         Helpers.get_end_of_node(cursor.node),
                     #     )
                     # )
-                    end_of_block.append(
-                        Helpers.get_end_of_node(cursor.node, newline_offsets)
-                    )
+                    end_of_block.append(Helpers.get_end_of_node(node))
                     level = level + 1
                 continue
 
             retracing = True
             while retracing:
-                # print("RETRACING", cursor.node.type)
-                if cursor.node.type in nodes_to_investigate:
-                    # print("DECREMENTING", cursor.node.type)
+                # print("RETRACING", node.type)
+                if node.type in nodes_to_investigate:
+                    # print("DECREMENTING", node.type)
                     # parents.pop()
                     level = level - 1
-                if not cursor.goto_parent():
-                    if cursor.node.type in nodes_to_investigate:
-                        # print("DECREMENTING", cursor.node.type)
+                if cursor.goto_parent():
+                    node = cursor.node
+                else:
+                    if node.type in nodes_to_investigate:
+                        # print("DECREMENTING", node.type)
                         # parents.pop()
                         level = level - 1
                     retracing = False
                     reached_root = True
 
                 if cursor.goto_next_sibling():
+                    node = cursor.node
                     retracing = False
 
-        print(end_of_block)
-
     @staticmethod
     def traverse_tree(tree: Tree):
         cursor = tree.walk()
@@ -229,31 +398,16 @@ class Helpers(object):
         #    print("####################")
 
     @staticmethod
-    def get_start_of_node(node, newline_offsets):
-        start_line = node.start_point[0]
-        start_offset = node.start_point[1]
-        start_matched_char_loc = newline_offsets[start_line] + start_offset
-
-        return start_matched_char_loc
+    def get_start_of_node(node):
+        return node.start_byte
 
     @staticmethod
-    def get_end_of_node(node, newline_offsets):
-        end_line = node.end_point[0]
-        end_offset = node.end_point[1]
-        end_matched_char_loc = newline_offsets[end_line] + end_offset
-
-        return end_matched_char_loc
+    def get_end_of_node(node):
+        return node.end_byte
 
     @staticmethod
-    def get_length_of_node(node, newline_offsets):
-        start_line = node.start_point[0]
-        start_offset = node.start_point[1]
-        end_line = node.end_point[0]
-        end_offset = node.end_point[1]
-        start_matched_char_loc = newline_offsets[start_line] + start_offset
-        end_matched_char_loc = newline_offsets[end_line] + end_offset
-
-        return end_matched_char_loc - start_matched_char_loc
+    def get_length_of_node(node):
+        return node.end_byte - node.start_byte
 
 
 #### Format Rules
@@ -278,22 +432,29 @@ class Helpers(object):
 # to create the tree, parser.
 class NormalizeText(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         # Normalizing will convert tabs to spaces, remove all leading whitespace,
         # collapse multiple spaces into one, remove starting spaces and
         # remove all empty lines.
-        data = re.sub("\t", " ", data)
-        data = re.sub(" +", " ", data)
-        data = re.sub(r"^$\n", "", data, flags=re.MULTILINE)
+        data = data.replace(b"\t", b" ")
+        data = MULTIPLE_SPACES_REGEX.sub(b" ", data)
+        # Dropping the empty lines is a literal split and join, so there's no
+        # need for the regex engine. Keep the final newline, which the split
+        # would otherwise lose.
+        lines = data.split(b"\n")
+        data = b"\n".join(filter(None, lines))
+        if not lines[-1]:
+            data += b"\n"
         data = data.lstrip()
 
-        return data, tree
+        # The data was rewritten, so the tree has to be rebuilt.
+        return data, None
 
 
 # Apply magic sigils - syntax sugar to help the formatter
 class ApplyMagicSigils(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         # Check if any lists end in "," if so, separate out the list entries
         # onto a new line.
         return data, tree
@@ -302,7 +463,7 @@ class ApplyMagicSigils(FormatRule):
 # Apply indentation to code
 class ApplyIndentation(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         return data, tree
 
 
@@ -310,30 +471,20 @@ class ApplyIndentation(FormatRule):
 # Once we space everything out, we'll do a final pass to do spacing and indentation.
 class JoinElementsOntoSingleLines(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
-
-        query = language.query(
-            """
-           ("[") @no_newline_both
-           ("]") @no_newline_to_left
-           (".") @no_newline_both
-           ("|") @no_newline_both
-           ("{") @no_newline_to_right
-           ("}") @no_newline_to_left
-           ("(") @no_newline_to_right
-           (")") @no_newline_to_left
-           """
-        )
+    def _format(arguments, data, tree, parser, language):
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        # Only newlines get removed, so a single line has nothing to join.
+        if b"\n" not in data:
+            return data, tree
 
+        query = Helpers.get_query(language, NEWLINE_ELEMENTS_QUERY)
+
+        captures = Helpers.get_query_result(tree, query, data)
+
+        edits = []
         for match in captures:
             match_type = match[1]
-            line = match[0].start_point[0]
-            offset = match[0].start_point[1]
-            matched_char_loc = newline_offsets[line] + offset
+            matched_char_loc = match[0].start_byte
             # print(data[matched_char_loc])
 
             # Skip the last char
@@ -347,19 +498,13 @@ class JoinElementsOntoSingleLines(FormatRule):
             ):
                 location_to_check = matched_char_loc - 1
                 char_to_check = data[location_to_check]
-                if char_to_check == "\n":
-                    data = data[:location_to_check] + data[matched_char_loc:]
-                    location_to_check = location_to_check - 1
-                    char_to_check = data[location_to_check]
+                if char_to_check == NEWLINE:
                     # Edge case - we allow two newlines in a row between blocks,
                     # and normalization doesn't know that this isn't a block, so
-                    # we need to reformat this again.
-                    # TODO: This logic should be cleaned up, it's kinda gnarly.
-                    if char_to_check == "\n":
-                        data = (
-                            data[:location_to_check]
-                            + data[(matched_char_loc - 1) :]
-                        )
+                    # we need to remove the second newline as well.
+                    if data[location_to_check - 1] == NEWLINE:
+                        location_to_check = location_to_check - 1
+                    edits.append((location_to_check, matched_char_loc, b""))
 
             # Handle Newlines to the right
             if (
@@ -368,22 +513,14 @@ class JoinElementsOntoSingleLines(FormatRule):
             ):
                 location_to_check = matched_char_loc + 1
                 char_to_check = data[location_to_check]
-                if char_to_check == "\n":
-                    data = (
-                        data[:location_to_check]
-                        + data[(location_to_check + 1) :]
-                    )
-                    # Edge case - we allow two newlines in a row between blocks,
-                    # and normalization doesn't know that this isn't a block, so
-                    # we need to reformat this again.
-                    # TODO: This logic should be cleaned up, it's kinda gnarly.
-                    location_to_check = matched_char_loc + 1
-                    char_to_check = data[location_to_check]
-                    if char_to_check == "\n":
-                        data = (
-                            data[:location_to_check]
-                            + data[(location_to_check + 1) :]
-                        )
+                if char_to_check == NEWLINE:
+                    end_of_newlines = location_to_check + 1
+                    # Edge case - same as above, remove the blank line too.
+                    if data[end_of_newlines : end_of_newlines + 1] == b"\n":
+                        end_of_newlines = end_of_newlines + 1
+                    edits.append((location_to_check, end_of_newlines, b""))
+
+        data = Helpers.apply_edits(data, edits, tree)
 
         return data, tree
 
@@ -391,7 +528,7 @@ class JoinElementsOntoSingleLines(FormatRule):
 # Separate Elements onto new lines that need to be separated
 class SeparateElementsOntoNewLines(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         return data, tree
 
 
@@ -399,7 +536,7 @@ class SeparateElementsOntoNewLines(FormatRule):
 # allow them to be longer than the 80 character limit
 class FormatComments(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         return data, tree
 
 
@@ -407,7 +544,7 @@ class FormatComments(FormatRule):
 # Reason: Historical Standard
 class NoMoreThan80Characters(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         return data, tree
 
 
@@ -420,8 +557,8 @@ class NoMoreThan80Characters(FormatRule):
 # fix this behavior.
 class EndOfFileNewLine(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
-        data = data + "\n"
+    def _format(arguments, data, tree, parser, language):
+        data = Helpers.apply_edits(data, [(len(data), len(data), b"\n")], tree)
         return data, tree
 
 
@@ -436,8 +573,16 @@ class EndOfFileNewLine(FormatRule):
 # that behavior on.
 class StripTrailingWhitespace(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
-        data = data.rstrip()
+    def _format(arguments, data, tree, parser, language):
+        stripped_length = len(data.rstrip())
+
+        # Nothing to strip - keep the data and tree as they are.
+        if stripped_length == len(data):
+            return data, tree
+
+        data = Helpers.apply_edits(
+            data, [(stripped_length, len(data), b"")], tree
+        )
         return data, tree
 
 
@@ -446,142 +591,104 @@ class StripTrailingWhitespace(FormatRule):
 # Rule: Use spaces around binary operators
 # Binary operators, including key binary operators,
 # should have one space before and after.
-class BinaryOperatorSpacing(FormatRule):
+class BinaryOperatorSpacing(SpacingRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def get_edits(arguments, data, tree, language):
 
-        query = language.query(
-            """
-           (binary_expression) @binary_exp
-           """
-        )
+        query = Helpers.get_query(language, BINARY_EXPRESSION_QUERY)
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        captures = Helpers.get_query_result(tree, query, data)
 
         # A binary expression will always have three parts
         # - A prefix
         # - The binary operator
         # - The suffix
-        # The binary operator itself is the second element
-        # in the binary expression child array.
+        # The binary operator itself is the "operator" field of
+        # the binary expression, which can be looked up without
+        # building the whole child array. If the grammar doesn't
+        # name the field, fall back to the second child.
         #
-        # We'll pull that out of the match array and then
-        # resort.
-
-        operators = []
+        # We'll pull that out of the match array. The edits are
+        # applied in one go, so the operators don't need to be sorted.
 
+        edits = []
         for match in captures:
-            operators.append(match[0].children[1])
-
-        operators = sorted(
-            operators,
-            key=lambda operator: [operator.start_point, operator.end_point],
-            reverse=True,
-        )
+            operator = match[0].child_by_field_name("operator")
+            if operator is None:
+                operator = match[0].children[1]
 
-        for operator in operators:
-
-            start_line = operator.start_point[0]
-            start_offset = operator.start_point[1]
-            end_line = operator.end_point[0]
-            end_offset = operator.end_point[1]
-            start_matched_char_loc = newline_offsets[start_line] + start_offset
-            end_matched_char_loc = newline_offsets[end_line] + end_offset
-            operator = data[start_matched_char_loc:end_matched_char_loc]
+            start_matched_char_loc = operator.start_byte
+            end_matched_char_loc = operator.end_byte
 
             # Handle the right side
-            if data[end_matched_char_loc] != " ":
-                data = (
-                    data[:start_matched_char_loc]
-                    + operator
-                    + " "
-                    + data[end_matched_char_loc:]
-                )
+            if data[end_matched_char_loc] != SPACE:
+                edits.append((end_matched_char_loc, end_matched_char_loc, b" "))
 
             # Handle the left side
-            if data[start_matched_char_loc - 1] != " ":
-                data = (
-                    data[:start_matched_char_loc]
-                    + " "
-                    + operator
-                    + data[end_matched_char_loc:]
+            if data[start_matched_char_loc - 1] != SPACE:
+                edits.append(
+                    (start_matched_char_loc, start_matched_char_loc, b" ")
                 )
 
-        return data, tree
+        return edits
 
 
 # Rule: Add spaces after commas.
 # Commas should have one space after, but not before.
-class AddSpacesAfterCommas(FormatRule):
+class AddSpacesAfterCommas(SpacingRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def get_edits(arguments, data, tree, language):
 
-        query = language.query(
-            """
-           (",") @comma
-           """
-        )
+        # Skip the query entirely if there aren't any commas.
+        if b"," not in data:
+            return []
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        query = Helpers.get_query(language, COMMA_QUERY)
+
+        captures = Helpers.get_query_result(tree, query, data)
 
+        edits = []
         for comma in captures:
-            line = comma[0].start_point[0]
-            offset = comma[0].start_point[1]
-            matched_char_loc = newline_offsets[line] + offset
+            matched_char_loc = comma[0].start_byte
 
             # Handle the right side
-            if data[matched_char_loc + 1] != " ":
-                data = (
-                    data[: (matched_char_loc + 1)]
-                    + " "
-                    + data[(matched_char_loc + 1) :]
-                )
+            if data[matched_char_loc + 1] != SPACE:
+                edits.append((matched_char_loc + 1, matched_char_loc + 1, b" "))
 
             # Handle the left side
-            if data[matched_char_loc - 1] == " ":
-                data = data[: (matched_char_loc - 1)] + data[matched_char_loc:]
+            if data[matched_char_loc - 1] == SPACE:
+                edits.append((matched_char_loc - 1, matched_char_loc, b""))
 
-        return data, tree
+        return edits
 
 
 # Rule: Add spaces around assignment.
 # Assignments should have one space after and before.
-class AddSpacesAroundAssignment(FormatRule):
+class AddSpacesAroundAssignment(SpacingRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def get_edits(arguments, data, tree, language):
 
-        query = language.query(
-            """
-           ("=") @assignment
-           """
-        )
+        # Skip the query entirely if there aren't any assignments.
+        if b"=" not in data:
+            return []
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        query = Helpers.get_query(language, ASSIGNMENT_QUERY)
+
+        captures = Helpers.get_query_result(tree, query, data)
 
+        edits = []
         for assignment in captures:
-            line = assignment[0].start_point[0]
-            offset = assignment[0].start_point[1]
-            matched_char_loc = newline_offsets[line] + offset
+            matched_char_loc = assignment[0].start_byte
 
             # Handle the right side
-            if data[matched_char_loc + 1] != " ":
-                data = (
-                    data[: (matched_char_loc + 1)]
-                    + " "
-                    + data[(matched_char_loc + 1) :]
-                )
+            if data[matched_char_loc + 1] != SPACE:
+                edits.append((matched_char_loc + 1, matched_char_loc + 1, b" "))
 
             # Handle the left side
-            if data[matched_char_loc - 1] != " ":
-                data = data[:matched_char_loc] + " " + data[matched_char_loc:]
+            if data[matched_char_loc - 1] != SPACE:
+                edits.append((matched_char_loc, matched_char_loc, b" "))
 
-        return data, tree
+        return edits
 
 
 # Rule: Don't use spaces before semicolons.
@@ -590,11 +697,16 @@ class AddSpacesAroundAssignment(FormatRule):
 #
 # x = 3 + 5 ; // incorrect
 # x = 3 + 5;  // correct
-class DontUseSpaceBeforeSemicolons(FormatRule):
+class DontUseSpaceBeforeSemicolons(SpacingRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
-        data = re.sub(" ;", ";", data)
-        return data, tree
+    def get_edits(arguments, data, tree, language):
+        if b" ;" not in data:
+            return []
+
+        return [
+            (match.start(), match.start() + 1, b"")
+            for match in SPACE_BEFORE_SEMICOLON_REGEX.finditer(data)
+        ]
 
 
 # Rule: Add spaces within curly brackets {},
@@ -615,9 +727,13 @@ class DontUseSpaceBeforeSemicolons(FormatRule):
 # a = f.value( 10 );
 # b = [ 1, 2, 3 ];
 # c = b.collect({| x | x + 3});
-class BracketSpacing(FormatRule):
+class BracketSpacing(SpacingRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def get_edits(arguments, data, tree, language):
+
+        # Skip the query entirely if there aren't any brackets.
+        if not any(bracket in data for bracket in b"()[]{}"):
+            return []
 
         # NB: The treesitter will not parse a parameter list with spaces,
         # so adding (parameter_list ("|") ("|")) @no_space to the query
@@ -628,60 +744,63 @@ class BracketSpacing(FormatRule):
         #
         # When the issue is resolved, it's a TODO to add the query for the parameter
         # list and the appropriate handling logic back in.
-        query = language.query(
-            """
-           ("(") @no_space_opening
-           (")") @no_space_closing
-           ("[") @no_space_opening
-           ("]") @no_space_closing
-           ("{") @space_opening
-           ("}") @space_closing
-           """
-        )
+        query = Helpers.get_query(language, BRACKET_QUERY)
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        captures = Helpers.get_query_result(tree, query, data)
 
+        edits = []
         for match in captures:
             match_type = match[1]
-            line = match[0].start_point[0]
-            offset = match[0].start_point[1]
-            matched_char_loc = newline_offsets[line] + offset
+            matched_char_loc = match[0].start_byte
 
             if match_type == "no_space_opening":
                 location_to_check = matched_char_loc + 1
                 char_to_check = data[location_to_check]
-                if char_to_check == " ":
-                    data = (
-                        data[: (matched_char_loc + 1)]
-                        + data[(location_to_check + 1) :]
+                if char_to_check == SPACE:
+                    edits.append(
+                        (location_to_check, location_to_check + 1, b"")
                     )
             elif match_type == "no_space_closing":
                 location_to_check = matched_char_loc - 1
                 char_to_check = data[location_to_check]
-                if char_to_check == " ":
-                    data = data[:location_to_check] + data[matched_char_loc:]
+                if char_to_check == SPACE:
+                    edits.append((location_to_check, matched_char_loc, b""))
 
             elif match_type == "space_opening":
                 location_to_check = matched_char_loc + 1
                 char_to_check = data[location_to_check]
-                if char_to_check != " ":
-                    data = (
-                        data[:location_to_check]
-                        + " "
-                        + data[(matched_char_loc + 1) :]
-                    )
+                if char_to_check != SPACE:
+                    edits.append((location_to_check, location_to_check, b" "))
 
             elif match_type == "space_closing":
                 location_to_check = matched_char_loc - 1
                 char_to_check = data[location_to_check]
-                if char_to_check != " ":
-                    data = (
-                        data[: (location_to_check) + 1]
-                        + " "
-                        + data[matched_char_loc:]
-                    )
+                if char_to_check != SPACE:
+                    edits.append((matched_char_loc, matched_char_loc, b" "))
+
+        return edits
+
+
+# Run all of the spacing rules above as one pass. Each of them only looks at
+# the characters right next to what it matched, so their edits can all be
+# worked out against the same data and applied together. This saves
+# rebuilding the data and reparsing the tree after every one of them.
+class SpacingPass(FormatRule):
+    rules = [
+        BracketSpacing,
+        DontUseSpaceBeforeSemicolons,
+        AddSpacesAroundAssignment,
+        BinaryOperatorSpacing,
+        AddSpacesAfterCommas,
+    ]
+
+    @staticmethod
+    def _format(arguments, data, tree, parser, language):
+        edits = []
+        for rule in SpacingPass.rules:
+            edits.extend(rule.get_edits(arguments, data, tree, language))
+
+        data = Helpers.apply_edits(data, edits, tree)
 
         return data, tree
 
@@ -692,7 +811,7 @@ class BracketSpacing(FormatRule):
 # The SuperCollider class library uses tabs for indentation.
 class UseTabsForIndentation(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         return data, tree
 
 
@@ -715,7 +834,7 @@ class UseTabsForIndentation(FormatRule):
 # };
 class UseKRStyle(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         return data, tree
 
 
@@ -743,7 +862,7 @@ class UseKRStyle(FormatRule):
 #    });
 class FormatDotNotation(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         # Find Dots:
         #   If the dot is the start of the line (e.g. prefaced by tabs)
         #   then only make sure there is no space after.
@@ -779,41 +898,39 @@ class FormatDotNotation(FormatRule):
 # is not a single literal must be enclosed in parentheses.
 class FormatParameterLists(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
-        query = language.query(
-            """
-           (parameter_list) @parameter_list
-           """
-        )
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+    def _format(arguments, data, tree, parser, language):
+        # A parameter list is either "arg ...;" or "|...|".
+        if b"|" not in data and b"arg" not in data:
+            return data, tree
+
+        query = Helpers.get_query(language, PARAMETER_LIST_QUERY)
+        captures = Helpers.get_query_result(tree, query, data)
 
         # NB: Spaces around "=" signs will be handled in another format rule.
+        edits = []
         for match in captures:
-            start_line = match[0].start_point[0]
-            start_offset = match[0].start_point[1]
-            matched_char_loc = newline_offsets[start_line] + start_offset
-            end_line = match[0].end_point[0]
-            end_offset = match[0].end_point[1]
-            end_matched_char_loc = newline_offsets[end_line] + end_offset
+            matched_char_loc = match[0].start_byte
+            end_matched_char_loc = match[0].end_byte
             argument_list = data[matched_char_loc:end_matched_char_loc]
 
             # Reformat beginning and end of argument list with pipes
-            argument_list = re.sub("^arg |;$", "|", argument_list)
+            new_argument_list = ARG_KEYWORD_REGEX.sub(b"|", argument_list)
 
             # If space exists but is not preceded by a comma, replace
             # with ", ". See 'Important Notes about Lookbehind' at
             # https://www.regular-expressions.info/lookaround.html
-            argument_list = re.sub("(?<!,) ", ", ", argument_list)
-
-            # Splice New Argument List Into Data
-            data = (
-                data[:matched_char_loc]
-                + argument_list
-                + data[end_matched_char_loc:]
+            new_argument_list = SPACE_WITHOUT_COMMA_REGEX.sub(
+                b", ", new_argument_list
             )
 
+            # Only splice in argument lists that actually changed
+            if new_argument_list != argument_list:
+                edits.append(
+                    (matched_char_loc, end_matched_char_loc, new_argument_list)
+                )
+
+        data = Helpers.apply_edits(data, edits, tree)
+
         return data, tree
 
 
@@ -835,37 +952,27 @@ class FormatParameterLists(FormatRule):
 # };
 class ParameterListAlignment(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         # Check to see if element list is on a different line than the
         # function bracket. If it is, remove the newline and ensure a
         # newline is after the last element.
 
-        query = language.query(
-            """
-           (parameter_list) @parameter_list
-           """
-        )
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        # A parameter list is either "arg ...;" or "|...|".
+        if b"|" not in data and b"arg" not in data:
+            return data, tree
+
+        query = Helpers.get_query(language, PARAMETER_LIST_QUERY)
+        captures = Helpers.get_query_result(tree, query, data)
 
+        edits = []
         for match in captures:
-            start_line = match[0].start_point[0]
-            start_offset = match[0].start_point[1]
-            matched_char_loc = newline_offsets[start_line] + start_offset
-            end_line = match[0].end_point[0]
-            end_offset = match[0].end_point[1]
-            end_matched_char_loc = newline_offsets[end_line] + end_offset
-            argument_list = data[matched_char_loc:end_matched_char_loc]
+            end_matched_char_loc = match[0].end_byte
             char_to_check = data[end_matched_char_loc]
 
-            if char_to_check != " ":
-                data = (
-                    data[:matched_char_loc]
-                    + argument_list
-                    + " "
-                    + data[end_matched_char_loc:]
-                )
+            if char_to_check != SPACE:
+                edits.append((end_matched_char_loc, end_matched_char_loc, b" "))
+
+        data = Helpers.apply_edits(data, edits, tree)
 
         return data, tree
 
@@ -901,18 +1008,17 @@ class ParameterListAlignment(FormatRule):
 # }
 class FormatReturnStatement(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
 
-        query = language.query(
-            """
-          (function_block) @function_block
-          """
-        )
+        # Skip the query entirely if there aren't any function blocks.
+        if b"{" not in data:
+            return data, tree
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        query = Helpers.get_query(language, FUNCTION_BLOCK_QUERY)
+
+        captures = Helpers.get_query_result(tree, query, data)
 
+        edits = []
         for match in captures:
 
             # Find the last statement - either a return statement or some
@@ -922,37 +1028,38 @@ class FormatReturnStatement(FormatRule):
 
             semicolon_found = False
             for child in reversed(match[0].children):
-                if child.type == ";":
+                child_type = child.type
+                if child_type == ";":
                     semicolon_found = True
-                if child.type != "}" and child.type != ";":
+                elif child_type not in NON_RETURN_NODE_TYPES:
                     return_statement = child
                     break
 
-            start_line = return_statement.start_point[0]
-            start_offset = return_statement.start_point[1]
-            matched_char_loc = newline_offsets[start_line] + start_offset
-            end_line = return_statement.end_point[0]
-            end_offset = return_statement.end_point[1]
-            end_matched_char_loc = newline_offsets[end_line] + end_offset
-            return_statement_text = data[matched_char_loc:end_matched_char_loc]
+            matched_char_loc = return_statement.start_byte
+            end_matched_char_loc = return_statement.end_byte
+
+            # NB: Only the semicolons are deleted, rather than replacing the
+            # whole statement. A function block nested in the statement has
+            # edits of its own, which would overlap an edit spanning the
+            # statement and be dropped.
 
             # Remove semicolon at end of statement to further distinguish return
-            return_statement_text = re.sub(";", "", return_statement_text)
-
-            # Splice Return Statement Into Data
-            if not semicolon_found:
-                data = (
-                    data[:matched_char_loc]
-                    + return_statement_text
-                    + data[end_matched_char_loc:]
-                )
-            else:
-                data = (
-                    data[:matched_char_loc]
-                    + return_statement_text
-                    + data[end_matched_char_loc + 1 :]
+            # Only the end - a semicolon inside the statement, e.g. in a
+            # function passed to it, has to stay.
+            stripped_char_loc = matched_char_loc + len(
+                data[matched_char_loc:end_matched_char_loc].rstrip(b";")
+            )
+            if stripped_char_loc < end_matched_char_loc:
+                edits.append((stripped_char_loc, end_matched_char_loc, b""))
+
+            # Remove the semicolon following it if there is one
+            if semicolon_found:
+                edits.append(
+                    (end_matched_char_loc, end_matched_char_loc + 1, b"")
                 )
 
+        data = Helpers.apply_edits(data, edits, tree)
+
         return data, tree
 
 
@@ -970,7 +1077,7 @@ class FormatReturnStatement(FormatRule):
 # ];
 class FormatMultieLineArray(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
         # Ensure that any array that has newlines has a newline between
         # each element and the indendation is one level in from its parent.
         return data, tree
@@ -1007,90 +1114,85 @@ class UseTrailingClosureSyntax(FormatRule):
 # as needed.
 class AddNewlinesInFunctions(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
-        query = language.query(
-            """
-          (function_block) @function_block
-          """
-        )
+    def _format(arguments, data, tree, parser, language):
+        # Skip the query entirely if there aren't any function blocks.
+        if b"{" not in data:
+            return data, tree
+
+        query = Helpers.get_query(language, FUNCTION_BLOCK_QUERY)
 
         # When we are determining how many statements a function has,
         # we are going to not include the parameter list and the semi-
         # colons. Likwise, we are going to not include any line that
         # starts with "var" as a statement.
-        type_filters = [";", "parameter_list", "{", "}"]
-        line_filter = "var "
+        type_filters = NON_STATEMENT_NODE_TYPES
+        line_filter = VAR_STATEMENT_PREFIX
 
-        captures, newline_offsets = Helpers.get_query_result_and_newline_data(
-            tree, query, data
-        )
+        captures = Helpers.get_query_result(tree, query, data)
 
+        edits = []
         for function_block in captures:
-            # print(function_block)
-            start_line = function_block[0].start_point[0]
-            start_offset = function_block[0].start_point[1]
-            end_line = function_block[0].end_point[0]
-            end_offset = function_block[0].end_point[1]
-            start_matched_char_loc = newline_offsets[start_line] + start_offset
-            end_matched_char_loc = newline_offsets[end_line] + end_offset
+            start_matched_char_loc = function_block[0].start_byte
+            end_matched_char_loc = function_block[0].end_byte
 
             function_length = end_matched_char_loc - start_matched_char_loc
-            children = list(
-                filter(
-                    lambda child: (
-                        not child.text.decode("ascii").startswith(line_filter)
-                        and not child.type in type_filters
-                    ),
-                    function_block[0].children,
-                )
-            )
-            var_list = list(
-                filter(
-                    lambda child: (
-                        child.text.decode("ascii").startswith(line_filter)
-                    ),
-                    function_block[0].children,
-                )
-            )
+            # Node.text copies the text out of the tree on every access.
+            original_text = function_block[0].text
 
             # If we have at most three statements in the function, we only have one
             # var statement *and* we have less than 80 characters in the line, we will
             # make sure the entire function is on one line.
             # Else, we'll separate the function into multiple lines per the style
             # guidelines above.
-            if (
-                len(children) <= 3
-                and function_length <= arguments.maximum_line_length
-                and len(var_list) == 1
-            ):
-                function_text = re.sub(
-                    "\n", "", function_block[0].text.decode("ascii")
-                )
+            #
+            # Only a function short enough for one line needs its children
+            # counted, so check the length first.
+            single_line = False
+            if function_length <= arguments.maximum_line_length:
+                # Sort the children into var statements and everything else
+                # in a single pass over them.
+                children = []
+                var_list = []
+                for child in function_block[0].children:
+                    if child.text.startswith(line_filter):
+                        var_list.append(child)
+                    elif child.type not in type_filters:
+                        children.append(child)
+
+                single_line = len(children) <= 3 and len(var_list) == 1
+
+            if single_line:
+                function_text = original_text.replace(b"\n", b"")
             else:
                 # If we have a long function, we're going to go through the children
                 # and put a newline after any semicolon, and then a newline after the
                 # return statment if it doesn't have a semicolon.
-                function_text = re.sub(
-                    "; ", ";\n", function_block[0].text.decode("ascii")
-                )
+                function_text = original_text.replace(b"; ", b";\n")
 
                 # And the end of the argument list, if it exists
-                function_text = re.sub("\| var", "|\nvar", function_text)
+                function_text = function_text.replace(b"| var", b"|\nvar")
 
                 # Normalize to one space if double happened by mistake
-                function_text = re.sub("\n\n", "\n", function_text)
+                function_text = function_text.replace(b"\n\n", b"\n")
 
                 # We've already normalized the return statement to not have a
                 # semicolon, so we need to update that too
-                function_text = re.sub("}$", "\n}", function_text)
+                if function_text.endswith(b"}"):
+                    function_text = function_text[:-1] + b"\n}"
 
-            # Join this function's data
-            data = (
-                data[:start_matched_char_loc]
-                + function_text
-                + data[end_matched_char_loc:]
+            # Already formatted functions don't need to be spliced back in.
+            if function_text == original_text:
+                continue
+
+            # Replace this function's data. A function nested in one that is
+            # replaced as well is dropped by apply_edits, as the outer
+            # function's text already has it rewritten.
+            edits.append(
+                (start_matched_char_loc, end_matched_char_loc, function_text)
             )
 
+        data = Helpers.apply_edits(data, edits, tree)
+
         return data, tree
 
 
@@ -1102,10 +1204,16 @@ class AddNewlinesInFunctions(FormatRule):
 #    (i.e. argument/parameter lists)
 class IndentFile(FormatRule):
     @staticmethod
-    def _FormatRule__format(arguments, data, tree, parser, language):
+    def _format(arguments, data, tree, parser, language):
+        # Work out every newline from the unedited tree first, then apply
+        # them and report them to the tree in one go.
+        edits = IndentFile.get_edits(arguments, data, tree, language)
+        data = Helpers.apply_edits(data, edits, tree)
 
-        # Get newline data for the tree.
-        newline_offsets = Helpers.get_all_newline_offsets(data)
+        return data, tree
+
+    @staticmethod
+    def get_edits(arguments, data, tree, language):
 
         # Create List of locations for indented lines
         indents = []
@@ -1119,9 +1227,7 @@ class IndentFile(FormatRule):
         # top_level_nodes = Helpers.get_significant_tree_nodes(tree)
 
         # This needs to somehow be recursive
-        # for node, level, blocks in Helpers.get_significant_tree_nodes(
-        #     newline_offsets, tree
-        # ):
+        # for node, level, blocks in Helpers.get_significant_tree_nodes(tree):
         #     start_line = node.start_point[0]
         #     start_offset = node.start_point[1]
         #     end_line = node.end_point[0]
@@ -1151,112 +1257,45 @@ class IndentFile(FormatRule):
 
         cursor = tree.walk()
         reached_root = False
-        nodes_to_investigate = [
-            "arithmetic_series",
-            "code_block",
-            "function_block",
-            "method_name",
-            "variable_definition",
-        ]
+        nodes_to_investigate = SIGNIFICANT_NODE_TYPES
 
-        # As a hack - newline doesn't play well with updates to the tree.
-        # From what I can tell, the newline character is special to the tree
-        # and putting it in an update to the tree causes the nodes to get out
-        # of whack.
-        #
-        # For example, putting in a new_node_end of (1,0) will parse happily into
-        # the tree edit, but when stepping into the next node, the end point will
-        # be a massive number, looking almost like an integer overflow.
-        #
-        # Therefore, as a hack e are going to put a form feed '\f' in place of a
-        # newline for now and then update the code with a real solution when
-        # I have talked through it with the relevant developers of the
-        # treesitter tool.
+        # Edits are collected while walking the tree and applied once the
+        # walk is done, so the tree and the offsets taken from it still match
+        # the data for the whole walk.
+        edits = []
 
         while reached_root == False:
 
-            # print(cursor.node.start_point)
-            # print(cursor.node.type)
-
             # Check Cursor
-            if cursor.node.type in nodes_to_investigate:
-                if cursor.node.type == "function_block":
-                    argument_check_cursor = cursor
-                    # Expected "{"
-                    argument_check_cursor.goto_first_child()
-                    # Will either be parameter list, var, or a statement
-                    # If the next sibling is a parameter list, we'll add
-                    # a newline after the parameter list, else we'll add
-                    argument_check_cursor.goto_next_sibling()
-                    print(argument_check_cursor.node.type)
-                    newline_offsets = Helpers.get_all_newline_offsets(data)
-                    if argument_check_cursor.node.type == "parameter_list":
-                        node = argument_check_cursor.node
-                        text_start = Helpers.get_start_of_node(
-                            node, newline_offsets
-                        )
-                        text_end = Helpers.get_end_of_node(
-                            node, newline_offsets
-                        )
-                        node_start = node.start_point
-                        data = data[:text_end] + "\n" + data[(text_end + 1) :]
-                        old_node_end = (node.end_point[0], node.end_point[1])
-                        new_node_end = (
-                            node.end_point[0],
-                            node.end_point[1],
-                        )
-                    else:
-                        node = cursor.node
-                        data = data[:text_start] + "\n" + data[text_start + 1 :]
-                        old_node_end = (node.end_point[0], node.end_point[1])
-                        new_node_end = (
-                            node.end_point[0],
-                            node.end_point[1],
-                        )
-
-                    tree.edit(
-                        # Bytes
-                        start_byte=text_start,
-                        old_end_byte=text_start + 1,
-                        new_end_byte=text_start + 1,
-                        # Nodes
-                        start_point=node_start,
-                        old_end_point=old_node_end,
-                        new_end_point=new_node_end,
-                    )
+            node = cursor.node
+            if node.type in nodes_to_investigate:
+                if node.type == "function_block":
+                    # The first child is the "{". The second will either be
+                    # a parameter list, var, or a statement. Look at it
+                    # with a cursor of its own rather than moving the main
+                    # one, so the walk carries on from the function block
+                    # itself.
+                    child_cursor = node.walk()
+                    child_cursor.goto_first_child()
+                    child_cursor.goto_next_sibling()
+                    first_child = child_cursor.node
+                    if first_child.type == "parameter_list":
+                        # Put the newline after the parameter list.
+                        text_end = Helpers.get_end_of_node(first_child)
+                        edits.append((text_end, text_end + 1, b"\n"))
+                    elif first_child.type != "}":
+                        # Put the newline before the first statement, in
+                        # place of the space after the "{" if there is one.
+                        # An empty block is left as it is.
+                        text_start = Helpers.get_start_of_node(first_child)
+                        if data[text_start - 1] == SPACE:
+                            edits.append((text_start - 1, text_start, b"\n"))
+                        else:
+                            edits.append((text_start, text_start, b"\n"))
 
                 else:
-                    node = cursor.node
-                    newline_offsets = Helpers.get_all_newline_offsets(data)
-                    text_start = Helpers.get_start_of_node(
-                        node, newline_offsets
-                    )
-                    text_end = Helpers.get_end_of_node(node, newline_offsets)
-                    node_start = node.start_point
-
-                    data = data[:text_start] + "\n" + data[text_start:]
-                    old_node_end = (node.end_point[0], node.end_point[1])
-                    new_node_end = (node.end_point[0], node.end_point[1] + 1)
-
-                    # print(node)
-                    # print(data)
-                    # print(old_node_end)
-                    # print(new_node_end)
-                    # print(type(node.end_point[0]))
-                    # node_end = (node.end_point[0] + 1, 0)
-                    tree.edit(
-                        # Bytes
-                        start_byte=text_start,
-                        old_end_byte=text_start + 1,
-                        new_end_byte=text_start + 2,
-                        # Nodes
-                        start_point=node_start,
-                        old_end_point=old_node_end,
-                        new_end_point=new_node_end,
-                    )
-                    # print("############")
-
-            # Rebuild Tree If Anything Changed
+                    text_start = Helpers.get_start_of_node(node)
+                    edits.append((text_start, text_start, b"\n"))
 
             if cursor.goto_first_child():
                 continue
@@ -1273,20 +1312,6 @@ class IndentFile(FormatRule):
                 if cursor.goto_next_sibling():
                     retracing = False
 
-        # print("###########")
-        # for indent in reversed(indents):
-        #     print(indent, indent[0].text)
-
-        # if start_offset == 0:
-        #    print(node)
-        #    print(
-        #        "Length: ",
-        #        end_matched_char_loc - start_matched_char_loc,
-        #        "Level: ",
-        #        level,
-        #    )
-        #    print(data[start_matched_char_loc:end_matched_char_loc])
-        #    print("#############")
         #     # Check to see what level this code block is on.
         #     # bound_with_parens = False
         #     # code_block
@@ -1296,9 +1321,7 @@ class IndentFile(FormatRule):
         #     #    # handle this backwards, so we are only going to append after
         #     #    # we are done processing the code block.
 
-        # data = re.sub("\f", "\n", data)
-
-        return data, tree
+        return edits
 
     # def process_code_block(data, level, code_block):
     #    pass
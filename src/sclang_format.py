@@ -7,23 +7,42 @@ coding conventions.
 #### Imports
 
 import argparse
+import concurrent.futures
+import functools
 import logging
 import format_rules as fr
+import os
 import re
 import sys
 
 from tree_sitter import Language, Parser, Tree
 
 #### Logger
+# Configured in main from --verbose, so importing the module doesn't set up
+# any handlers.
 log = logging.getLogger("root")
 LOG_FORMAT = "[%(asctime)s] %(message)s"
-logging.basicConfig(format=LOG_FORMAT)
-log.setLevel(logging.DEBUG)
+LOG_LEVELS = [logging.WARNING, logging.INFO, logging.DEBUG]
+
+#### Regular Expressions
+# Used by naive_normalize. Both only match where there is something to
+# replace - a single space or a pair of newlines is left alone.
+MULTIPLE_SPACES_REGEX = re.compile(b" {2,}")
+MULTIPLE_NEWLINES_REGEX = re.compile(b"\n{3,}")
 
 #### Constants
 
 STD_IN = "-"
 
+# Files picked up when formatting a directory
+SUPERCOLLIDER_EXTENSIONS = (".sc", ".scd")
+
+# Accepted spellings of boolean arguments
+TRUE_STRINGS = frozenset(["yes", "true", "y", "t", "1"])
+FALSE_STRINGS = frozenset(["no", "false", "n", "f", "0"])
+
+ERROR_QUERY = """ (ERROR) @error """
+
 # List Of Format Rule Classes
 pre_format = [
     fr.NoMoreThan80Characters,
@@ -36,11 +55,10 @@ pre_format = [
 ]
 inline_format = [
     fr.FormatParameterLists,
-    fr.BracketSpacing,
-    fr.DontUseSpaceBeforeSemicolons,
-    fr.AddSpacesAroundAssignment,
-    fr.BinaryOperatorSpacing,
-    fr.AddSpacesAfterCommas,
+    # Runs BracketSpacing, DontUseSpaceBeforeSemicolons,
+    # AddSpacesAroundAssignment, BinaryOperatorSpacing and
+    # AddSpacesAfterCommas together.
+    fr.SpacingPass,
     fr.FormatReturnStatement,
     fr.ParameterListAlignment,
 ]
@@ -64,28 +82,83 @@ def main():
     ### Parse and display arguments
     arguments = parse_arguments()
 
+    ### Set up logging for the requested verbosity
+    logging.basicConfig(
+        format=LOG_FORMAT,
+        level=LOG_LEVELS[min(arguments.verbose, len(LOG_LEVELS) - 1)],
+    )
+
+    ### Format code sent over stdin until it is closed, if asked to
+    if arguments.batch:
+        sys.exit(format_batch(arguments))
+
+    ### Format every file in the directory, if one was passed
+    if arguments.supercollider_directory is not None:
+        sys.exit(format_directory(arguments))
+
     ### Read the passed file or from stdin
     data = read_file(arguments)
 
+    ### Get the treesitter language object
+    language, parser = get_treesitter_parser(arguments)
+
+    ### Format the code
+    data, errors = format_source(arguments, data, language, parser)
+
+    # If there is an error in the parsing, return with
+    # error code.
+    if len(errors) > 0:
+        print_unparsable_sections(arguments, data, errors)
+        sys.exit(1)
+
+    # Write the text to standard out as it is, in a single write. The
+    # formatted code already ends with a newline (see EndOfFileNewLine).
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
+    sys.exit(0)
+
+
+def format_source(arguments, data, language, parser):
+    """
+    Formats SuperCollider code with an already loaded parser, so it can be
+    called for many files without reloading the language.
+
+    Parameters
+    ----------
+    arguments: Command-line arguments
+    data: SuperCollider code as UTF-8 bytes, as read by read_file
+    language: Treesitter language object
+    parser: Treesitter parser object
+
+    Returns
+    ----------
+    data: Formatted code as UTF-8 bytes. If the code doesn't parse, the
+          normalized code the errors refer to.
+    errors: Unparsable sections of the code, empty if it parsed
+    """
+
     ### Naive normalization to accomidate this bug:
     ### https://github.com/madskjeldgaard/tree-sitter-supercollider/issues/42
+    ### The data stays as the UTF-8 bytes it was read as - the parser and the
+    ### format rules all work on them, so offsets from the tree index
+    ### straight into it.
     data = naive_normalize(data)
 
-    ### Get the treesitter language object
-    language, parser = get_treesitter_parser(arguments)
-
     ### Get the tree
     tree = fr.Helpers.get_tree(parser, data, None)
 
     ### Check if code parses
-    query = language.query(""" (ERROR) @error """)
-    captures = query.captures(tree.root_node)
+    # The tree keeps a flag on every node for whether there's an error
+    # anywhere under it, so only look for the error nodes if the root
+    # has it set.
+    if tree.root_node.has_error:
+        query = fr.Helpers.get_query(language, ERROR_QUERY)
+        captures = query.captures(tree.root_node)
 
-    # If there is an error in the parsing, return with
-    # error code.
-    if len(captures) > 0:
-        print_unparsable_sections(arguments, data, captures)
-        sys.exit(1)
+        # If there is an error in the parsing, there is nothing to format.
+        if len(captures) > 0:
+            return data, captures
 
     ### Run the pre-formatters
     for f in pre_format:
@@ -99,11 +172,165 @@ def main():
     for f in post_format:
         data, tree = f.format(arguments, data, tree, parser, language)
 
-    # Print the text to standard out
-    # TODO: Is there a better way to handle this ?
-    print(data)
+    return data, []
 
-    sys.exit(0)
+
+def format_batch(arguments):
+    """
+    Formats any number of pieces of SuperCollider code sent over stdin with
+    a single loaded parser, so e.g. an editor can keep one process running
+    rather than starting one per format.
+
+    Each request is the length of the code in bytes on a line of its own,
+    followed by the UTF-8 encoded code. Each response is a status and a
+    length on a line of their own, followed by that many bytes: the
+    formatted code if the status is 0, or the unparsable sections or the
+    failure if it is 1.
+
+    Parameters
+    ----------
+    arguments: Command-line arguments
+
+    Returns
+    ----------
+    exit_code: 0 once stdin is closed, 1 if a request has no valid length
+               or is cut short
+    """
+
+    language, parser = get_treesitter_parser(arguments)
+
+    # Editors tend to send the same code again when it hasn't changed since
+    # the last format, so remember the latest responses and skip parsing
+    # and formatting entirely for those.
+    @functools.lru_cache(maxsize=64)
+    def respond(data):
+        # Answer code that can't be formatted with an error, so the session
+        # carries on with the next request.
+        try:
+            data, errors = format_source(arguments, data, language, parser)
+        except Exception as error:
+            log.debug("Failed to format a request", exc_info=True)
+            return 1, describe_exception(error).encode("utf8")
+
+        status = 0
+        if len(errors) > 0:
+            status = 1
+            data = "\n".join(describe_unparsable_sections(data, errors))
+            data = data.encode("utf8")
+
+        return status, data
+
+    requests = sys.stdin.buffer
+    responses = sys.stdout.buffer
+    while True:
+        header = requests.readline()
+        if not header:
+            break
+
+        # Without a valid length there's no telling where the next request
+        # starts, and code cut short by the end of stdin isn't all there,
+        # so either ends the session.
+        try:
+            length = int(header)
+            if length < 0:
+                raise ValueError("negative length " + str(length))
+
+            data = requests.read(length)
+            if len(data) < length:
+                raise EOFError(
+                    "expected " + str(length) + " bytes, got " + str(len(data))
+                )
+        except (ValueError, EOFError) as error:
+            data = describe_exception(error).encode("utf8")
+            responses.write(b"1 %d\n" % len(data))
+            responses.write(data)
+            responses.flush()
+            return 1
+
+        status, data = respond(data)
+
+        responses.write(b"%d %d\n" % (status, len(data)))
+        responses.write(data)
+        responses.flush()
+
+    return 0
+
+
+def format_directory(arguments):
+    """
+    Formats every SuperCollider file under a directory in place, spread
+    over a pool of processes. Files that don't parse, or that fail to
+    format, are reported and left as they are.
+
+    Parameters
+    ----------
+    arguments: Command-line arguments
+
+    Returns
+    ----------
+    exit_code: 1 if any of the files didn't parse or couldn't be formatted,
+               else 0
+    """
+
+    paths = []
+    for root, _, file_names in os.walk(arguments.supercollider_directory):
+        for file_name in sorted(file_names):
+            if file_name.endswith(SUPERCOLLIDER_EXTENSIONS):
+                paths.append(os.path.join(root, file_name))
+
+    exit_code = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=arguments.jobs
+    ) as executor:
+        for path, errors in executor.map(
+            functools.partial(format_file, arguments), paths
+        ):
+            if len(errors) > 0:
+                print(path)
+                for error in errors:
+                    print(error)
+                exit_code = 1
+
+    return exit_code
+
+
+def format_file(arguments, path):
+    """
+    Formats a single SuperCollider file in place. Runs in a worker process,
+    which loads the treesitter language once for all the files it is given.
+
+    Parameters
+    ----------
+    arguments: Command-line arguments
+    path: Path of the file to format
+
+    Returns
+    ----------
+    path: Path of the file
+    errors: Descriptions of the unparsable sections, or of the failure if
+            the file couldn't be formatted. Empty if it was formatted.
+    """
+
+    # Report a file that can't be formatted like one that doesn't parse,
+    # rather than letting the exception take down the whole pool.
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+
+        language, parser = get_treesitter_parser(arguments)
+        data, errors = format_source(arguments, data, language, parser)
+
+        # The nodes can't be sent back from the worker, so describe them here.
+        if len(errors) > 0:
+            return path, describe_unparsable_sections(data, errors)
+
+        with open(path, "wb") as file:
+            file.write(data)
+    except Exception as error:
+        log.debug("Failed to format %s", path, exc_info=True)
+        return path, [describe_exception(error)]
+
+    return path, []
 
 
 def parse_arguments():
@@ -124,6 +351,29 @@ def parse_arguments():
         default=STD_IN,
         required=False,
     )
+    parser.add_argument(
+        "-d",
+        "--supercollider_directory",
+        help="Absolute path of a directory to format every file of in place "
+        + "- overrides --supercollider_file",
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help="Format length-prefixed code read from stdin until it is "
+        + "closed - overrides --supercollider_file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes used with --supercollider_directory "
+        + "- default (one per CPU)",
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "-l",
         "--treesitter_library",
@@ -135,6 +385,7 @@ def parse_arguments():
         "-t",
         "--use_tabs",
         help="Use Tabs for spacing - default (True)",
+        type=str_to_bool,
         default=True,
     )
 
@@ -145,19 +396,26 @@ def parse_arguments():
         default=80,
     )
 
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Log more - once for info, twice for debug - default (warnings)",
+        action="count",
+        default=0,
+    )
+
     arguments = parser.parse_args()
-    arguments.use_tabs = str_to_bool(arguments.use_tabs)
 
     return arguments
 
 
 def str_to_bool(value):
-
-    if isinstance(value, bool):
-        return value
-    elif value.lower() in ("yes", "true", "y", "t", "1"):
+    # Only called by argparse on strings given on the command line - the
+    # default is already a bool.
+    value = value.lower()
+    if value in TRUE_STRINGS:
         return True
-    elif value.lower() in ("no", "false", "n", "f", "0"):
+    elif value in FALSE_STRINGS:
         return False
     else:
         raise argparse.ArgumentTypeError("Boolean Type Expected")
@@ -175,8 +433,15 @@ def get_treesitter_parser(arguments):
     ----------
     parser: Treesitter parser object
     """
+    return load_treesitter_parser(arguments.treesitter_library)
+
+
+# Loading the language opens the shared library, so only do it once per
+# library and hand back the same language and parser after that.
+@functools.lru_cache(maxsize=4)
+def load_treesitter_parser(treesitter_library):
     language = Language(
-        arguments.treesitter_library,
+        treesitter_library,
         "supercollider",
     )
     parser = Parser()
@@ -196,14 +461,16 @@ def read_file(arguments):
 
     Returns
     ----------
-    file_lines: File parsed into an array of lines
+    data: Contents of the file as UTF-8 bytes
     """
 
+    # Read the raw bytes in one go. They are what the tree-sitter parses, so
+    # there's no need to decode them. stdin isn't used as a context manager,
+    # as leaving the block would close it.
     if arguments.supercollider_file == STD_IN:
-        with sys.stdin as file:
-            data = file.read()
+        data = sys.stdin.buffer.read()
     else:
-        with open(arguments.supercollider_file, "r", encoding="utf8") as file:
+        with open(arguments.supercollider_file, "rb") as file:
             data = file.read()
 
     return data
@@ -212,38 +479,41 @@ def read_file(arguments):
 def naive_normalize(data):
     # Do some of the normalization here as well.
     # This method needs to be removed once the parsing bug is fixed.
-    data = re.sub("\t", " ", data)
-    data = re.sub(" +", " ", data)
+    #
+    # All but two of the substitutions are fixed strings, so they use
+    # bytes.replace rather than going through the regex engine.
+    data = data.replace(b"\t", b" ")
+    data = MULTIPLE_SPACES_REGEX.sub(b" ", data)
 
     # Replace two or more newlines with two newlines. This is to allow
     # separation between logical blocks, but not allow an excess of
     # whitespace, similar to how black does it.
-    data = re.sub(r"\n[\n]+", "\n\n", data)
+    data = MULTIPLE_NEWLINES_REGEX.sub(b"\n\n", data)
 
     # Don't allow whitespace to follow a newline. Stripping seems to not
     # work for some of these use cases, so this takes care of that
     # manually.
-    data = re.sub(r"\n ", "\n", data)
+    data = data.replace(b"\n ", b"\n")
 
     # Remove spaces around assignments to allow for parsing and address
     # the bug in the argument list.
-    data = re.sub("= ", "=", data)
-    data = re.sub(" =", "=", data)
+    data = data.replace(b"= ", b"=")
+    data = data.replace(b" =", b"=")
 
     # Remove spaces around pipes to allow for parsing and address
     # the bug in the argument list. We currently don't have any
     # semantics here, so we can't say to only remove the spaces
     # within the argument list.
-    data = re.sub("\| ", "|", data)
-    data = re.sub(" \|", "|", data)
+    data = data.replace(b"| ", b"|")
+    data = data.replace(b" |", b"|")
 
     # Strip is not removing the whitespace after the open brace.
     # Not sure why this is - this is a hack to clean this up.
-    data = re.sub("{ ", "{", data)
+    data = data.replace(b"{ ", b"{")
 
     # If 'play' at end of line with no semicolon, add semicolon
     # after play. Tree won't parse without it.
-    data = re.sub("play\n", "play;\n", data)
+    data = data.replace(b"play\n", b"play;\n")
 
     # Remove all whitespaces
     data = data.strip()
@@ -252,17 +522,24 @@ def naive_normalize(data):
 
 
 def print_unparsable_sections(arguments, data, errors):
-    newline_offsets = fr.Helpers.get_all_newline_offsets(data)
+    for description in describe_unparsable_sections(data, errors):
+        print(description)
+
+
+def describe_unparsable_sections(data, errors):
+    descriptions = []
     for error in errors:
         start_line = error[0].start_point[0]
         start_offset = error[0].start_point[1]
-        end_line = error[0].end_point[0]
-        end_offset = error[0].end_point[1]
-        start_matched_char_loc = newline_offsets[start_line] + start_offset
-        end_matched_char_loc = newline_offsets[end_line] + end_offset
-        bad_data = data[start_matched_char_loc:end_matched_char_loc]
+        start_matched_char_loc = error[0].start_byte
+        end_matched_char_loc = error[0].end_byte
+        # The input is never validated as UTF-8, so an error node can hold
+        # bytes that don't decode - show those as replacement characters.
+        bad_data = data[start_matched_char_loc:end_matched_char_loc].decode(
+            "utf8", errors="replace"
+        )
 
-        print(
+        descriptions.append(
             "Error: "
             + str(start_line)
             + ":"
@@ -272,6 +549,12 @@ def print_unparsable_sections(arguments, data, errors):
             + "]"
         )
 
+    return descriptions
+
+
+def describe_exception(error):
+    return "Error: " + type(error).__name__ + " - " + str(error)
+
 
 if __name__ == "__main__":
     main()